@@ -39,6 +39,8 @@ classes = [
     operators.recorder.RecorderStop,
     operators.hands.ResetHands,
     operators.hands.LoadHands,
+    operators.batch.BatchConvertTakes,
+    operators.batch.ExportRetargetPlans,
 ]
 
 
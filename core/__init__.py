@@ -1,3 +1,11 @@
+import sys
+from os.path import dirname, abspath, join
+
+# Add lib directory with bpy-independent modules to module search path
+lib_dir = join(abspath(dirname(dirname(__file__))), 'lib')
+if lib_dir not in sys.path:
+    sys.path.append(lib_dir)
+
 if "bpy" not in locals():
     import bpy
     from . import receiver
@@ -5,5 +13,13 @@ if "bpy" not in locals():
 else:
     import importlib
 
+    import cptr_motion.hand
+    import cptr_motion.retarget
+    import cptr_motion.batch
+    import cptr_motion.export
+    importlib.reload(cptr_motion.hand)
+    importlib.reload(cptr_motion.retarget)
+    importlib.reload(cptr_motion.batch)
+    importlib.reload(cptr_motion.export)
     importlib.reload(receiver)
     importlib.reload(utils)
@@ -1,67 +1,13 @@
 import bpy
 from mathutils import Quaternion
 
+import json
 import os.path
 import pathlib
 
-
-mpii_joints = [
-    "root",
-
-    "thumb1",
-    "thumb2",
-    "thumb3",
-    "thumb4",
-
-    "index1",
-    "index2",
-    "index3",
-    "index4",
-
-    "middle1",
-    "middle2",
-    "middle3",
-    "middle4",
-
-    "ring1",
-    "ring2",
-    "ring3",
-    "ring4",
-
-    "pinky1",
-    "pinky2",
-    "pinky3",
-    "pinky4",
-]
-
-mpii_parents = dict(
-    root=None,
-
-    thumb1='root',
-    thumb2='thumb1',
-    thumb3='thumb2',
-    thumb4='thumb3',
-
-    index1='root',
-    index2='index1',
-    index3='index2',
-    index4='index3',
-
-    middle1='root',
-    middle2='middle1',
-    middle3='middle2',
-    middle4='middle3',
-
-    ring1='root',
-    ring2='ring1',
-    ring3='ring2',
-    ring4='ring3',
-
-    pinky1='root',
-    pinky2='pinky1',
-    pinky3='pinky2',
-    pinky4='pinky3',
-)
+import numpy as np
+from cptr_motion.hand import mpii_joints, mpii_parents  # noqa: F401
+from cptr_motion.retarget import RetargetPlan
 
 
 def create_hands():
@@ -82,35 +28,147 @@ def create_hands():
         return left, right
 
 
-def load_hands():
-    filepath = pathlib.Path(os.path.dirname(__file__)).parent.resolve() / "resources" / "handlmoved.blend"
+hand_prefixes = ("left_", "right_")
+
+# Objects of the bundled rig are appended once under this prefix and kept out of the scene as templates
+template_prefix = "cptr_template_"
 
+
+def hand_templates():
+    templates = [obj for obj in bpy.data.objects if obj.name.startswith(template_prefix)]
+    if templates:
+        return templates
+
+    filepath = pathlib.Path(os.path.dirname(__file__)).parent.resolve() / "resources" / "handlmoved.blend"
     with bpy.data.libraries.load(str(filepath)) as (data_from, data_to):
+        names = list(data_from.objects)
         data_to.objects = data_from.objects
 
-    objects = bpy.context.view_layer.active_layer_collection.collection.objects
-    for obj in data_to.objects:
+    for name, obj in zip(names, data_to.objects):
         if obj is not None:
-            objects.link(obj)
+            obj.name = template_prefix + name
+            obj.use_fake_user = True
+            templates.append(obj)
+    return templates
+
+
+def load_hands():
+    # Instances share mesh and armature data with the templates, so creating a rig doesn't touch the disk
+    objects = bpy.context.view_layer.active_layer_collection.collection.objects
+    copies = {}
+    for template in hand_templates():
+        obj = template.copy()
+        obj.name = template.name[len(template_prefix):]
+        objects.link(obj)
+        copies[template] = obj
+
+    for obj in copies.values():
+        if obj.parent in copies:
+            obj.parent = copies[obj.parent]
+        for modifier in obj.modifiers:
+            if getattr(modifier, "object", None) in copies:
+                modifier.object = copies[modifier.object]
+    return list(copies.values())
+
+
+def read_retarget_map(path):
+    # {prefix: {"armature": object name, "bones": {joint: bone name or {"bone", "axis", "roll"}}}}
+    with open(bpy.path.abspath(path)) as f:
+        retarget_map = json.load(f)
+
+    if not isinstance(retarget_map, dict):
+        raise ValueError(f"Retarget map {path} must be a JSON object with left_ and right_ keys")
+    for prefix, config in retarget_map.items():
+        if prefix not in hand_prefixes:
+            raise ValueError(f"Unknown hand {prefix!r} in retarget map {path}, expected one of {', '.join(hand_prefixes)}")
+        if not isinstance(config, dict):
+            raise ValueError(f"Retarget map {path}: {prefix} must be a JSON object")
+        unknown = sorted(set(config) - {"armature", "bones"})
+        if unknown:
+            raise ValueError(
+                f"Unknown keys {', '.join(unknown)} for {prefix} in retarget map {path}, expected armature and bones")
+        if not isinstance(config.get("bones", {}), dict):
+            raise ValueError(f"Retarget map {path}: bones of {prefix} must be a JSON object")
+        if not isinstance(config.get("armature", ""), str):
+            raise ValueError(f"Retarget map {path}: armature of {prefix} must be an object name")
+    return retarget_map
+
+
+def load_retarget_map():
+    prefs = bpy.context.preferences.addons['cptr-tech'].preferences
+    return read_retarget_map(prefs.retarget_map) if prefs.retarget_map else {}
+
+
+def make_hands(retarget_map):
+    return tuple(Hand(prefix, **retarget_map.get(prefix, {})) for prefix in hand_prefixes)
+
+
+def init_hands():
+    retarget_map = load_retarget_map()
+    left_hand, right_hand = hands = make_hands(retarget_map)
+
+    if not retarget_map:
+        if not left_hand.object and not right_hand.object:
+            load_hands()
+    else:
+        # Custom rigs are never replaced with the bundled one, it wouldn't be driven by these hands
+        missing = [hand.armature for hand in hands if hand.prefix in retarget_map and hand.object is None]
+        if missing:
+            raise ValueError(f"Armature {', '.join(missing)} from the retarget map is not in the scene")
+    left_hand.save_pose()
+    right_hand.save_pose()
+    if bpy.context.object is not None:
+        bpy.ops.object.mode_set(mode="OBJECT")
+    bpy.ops.object.select_all(action="DESELECT")
+    return hands
+
+
+def import_take(hands, name, data, frame_offset=0):
+    # data holds <prefix>bones, frames, rotations and scales of a take converted by cptr_motion.batch.
+    # Hands driving the same armature, e.g. both hands of a full-body rig, share one action per take.
+    actions = {}
+    for hand in hands:
+        frames = data[hand.prefix + 'frames']
+        if hand.object is None or not len(frames):
+            continue
+        action = actions.get(hand.armature)
+        if action is None:
+            action = actions[hand.armature] = bpy.data.actions.new(f"{hand.armature}_{name}")
+            action.use_fake_user = True
+            if hand.object.animation_data is None:
+                hand.object.animation_data_create()
+            hand.object.animation_data.action = action
+        hand.import_animation(
+            action, data[hand.prefix + 'bones'], frames, data[hand.prefix + 'rotations'], data[hand.prefix + 'scales'],
+            frame_offset=frame_offset,
+        )
+    return list(actions.values())
 
 
 class Hand:
-    def __init__(self, prefix):
+    def __init__(self, prefix, armature=None, bones=None):
         self.prefix = prefix
-        self.to_ref_quats = {None: Quaternion()}
-        self.ref_scales = {None: 1.}
+        self.armature = armature or prefix + "Skeleton"
+        self.plan = RetargetPlan(bones) if bones else RetargetPlan.identity()
+        self.rest_heads = np.zeros((0, 3))
+        self.rest_tails = np.zeros((0, 3))
+        self.rest_quats = np.zeros((0, 4))
         self.enable_scale = False
 
     @property
     def object(self):
-        name = self.prefix + "Skeleton"
-        if name in bpy.data.objects:
-            return bpy.data.objects[name]
+        if self.armature in bpy.data.objects:
+            return bpy.data.objects[self.armature]
 
     def reset_pose(self):
         if self.object is None:
             return
-        for bone in self.object.pose.bones:
+        # Only the driven bones, with a custom map the rest of the rig isn't ours to touch
+        bones = self.object.pose.bones
+        for name in self.plan.bone_names:
+            bone = bones.get(name)
+            if bone is None:
+                continue
             bone.rotation_mode = "QUATERNION"
             bone.rotation_quaternion = Quaternion()
             bone.scale = (1, 1, 1)
@@ -118,35 +176,58 @@ class Hand:
     def save_pose(self):
         if self.object is None:
             return
+        self.plan = self.plan.restricted(self.object.data.bones.keys())
+        # Production rigs often use Euler modes, rotation_quaternion would have no effect on them
+        for name in self.plan.bone_names:
+            self.object.pose.bones[name].rotation_mode = "QUATERNION"
         self.object.select_set(True)
         bpy.context.view_layer.objects.active = self.object
         bpy.ops.object.mode_set(mode="EDIT", toggle=False)
         edit_bones = self.object.data.edit_bones
-        ref_quats = {None: Quaternion()}
-        for joint in mpii_joints:
-            parent = mpii_parents[joint]
-            if joint in edit_bones:
-                ref_quats[joint] = quat = edit_bones[joint].matrix.to_quaternion()
-                self.ref_scales[joint] = edit_bones[joint].length
-            else:
-                ref_quats[joint] = quat = ref_quats[parent]
-                self.ref_scales[joint] = self.ref_scales[parent]
-            self.to_ref_quats[joint] = quat.inverted() @ ref_quats[parent]
-
-    def process_bones(self, relative_rotations, relative_scales):
+        rest_quats = np.array([tuple(edit_bones[name].matrix.to_quaternion()) for name in self.plan.bone_names])
+        rest_lengths = np.array([edit_bones[name].length for name in self.plan.bone_names])
+        self.rest_heads = np.array([tuple(edit_bones[name].head) for name in self.plan.bone_names]).reshape(-1, 3)
+        self.rest_tails = np.array([tuple(edit_bones[name].tail) for name in self.plan.bone_names]).reshape(-1, 3)
+        self.rest_quats = rest_quats.reshape(-1, 4)
+        self.plan.compile(self.rest_quats, rest_lengths)
+
+    def process_bones(self, relative_rotations, relative_scales, keyframe=False):
+        rotations, scales = self.plan.apply(relative_rotations, relative_scales)
+        self.apply_pose(rotations, scales, keyframe=keyframe)
+        return rotations, scales
+
+    def apply_pose(self, rotations, scales, keyframe=False):
+        # Push a single frame computed by RetargetPlan.apply into the armature
+        if self.object is None:
+            return
+        bones = self.object.pose.bones
+        for idx, name in enumerate(self.plan.bone_names):
+            obj = bones.get(name)
+            if obj is None:
+                continue
+            obj.rotation_quaternion = rotations[idx]
+            if self.enable_scale:
+                scale = scales[idx]
+                obj.scale = (scale, scale, scale)
+            if keyframe:
+                obj.keyframe_insert(data_path="rotation_quaternion", index=-1)
+
+    def import_animation(self, action, bone_names, frames, rotations, scales, frame_offset=0):
+        # Write a whole take processed by cptr_motion into action, one bulk foreach_set per fcurve
+        channels = [("rotation_quaternion", rotations)]
+        if self.enable_scale:
+            channels.append(("scale", np.repeat(scales[..., None], 3, axis=-1)))
+        co = np.empty((len(frames), 2), dtype=np.float32)
+        co[:, 0] = np.asarray(frames) + frame_offset
+
         bones = self.object.pose.bones
-        from .receiver import receiver
-        for idx, bone in enumerate(mpii_joints):
-            parent = mpii_parents[bone]
-            rel_quat = relative_rotations[idx]
-            rel_scale = relative_scales[idx - 1] if idx else 1.
-
-            if bone in bones:
-                obj = bones[bone]
-                quat = self.to_ref_quats[bone] @ Quaternion(rel_quat)
-                obj.rotation_quaternion = quat
-                if self.enable_scale:
-                    scale = rel_scale * self.ref_scales[parent] / self.ref_scales[bone]
-                    obj.scale = (scale, scale, scale)
-                if receiver.is_recording:
-                    obj.keyframe_insert(data_path="rotation_quaternion", index=-1)
+        for idx, bone in enumerate(bone_names):
+            if bone not in bones:
+                continue
+            for data_path, values in channels:
+                for axis in range(values.shape[-1]):
+                    fcurve = action.fcurves.new(f'pose.bones["{bone}"].{data_path}', index=axis, action_group=bone)
+                    fcurve.keyframe_points.add(len(frames))
+                    co[:, 1] = values[:, idx, axis]
+                    fcurve.keyframe_points.foreach_set("co", co.ravel())
+                    fcurve.update()
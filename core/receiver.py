@@ -5,9 +5,10 @@ import errno
 import logging
 import sys
 from datetime import datetime
-from os.path import dirname, abspath, join
+from os.path import dirname, abspath, join, splitext
 
 from . import minimal_hand
+from cptr_motion.export import BvhStreamWriter, NpzStreamWriter
 
 logger = logging.getLogger(__name__)
 
@@ -39,9 +40,12 @@ class CptrError(Exception):
 class Receiver:
     def __init__(self):
         self.websocket_connection = None
+        self.left_hand = self.right_hand = None
+        self.exporters = {}
         self.reset_state()
 
     def reset_state(self):
+        self.stop_export()
         self.is_running = False
         self.is_recording = False
         self.is_in_transition = False
@@ -63,19 +67,70 @@ class Receiver:
             timestamp_delta = 0
         frame_idx = bpy.context.scene.frame_current + timestamp_delta
         logger.debug(f"Hands: {data['hands'].keys()}")
-        if self.is_recording:
+        if self.exporters:
+            # Exported takes are counted from their first frame and never touch the scene timeline
+            self.export_frame = 0 if self.export_frame is None else self.export_frame + timestamp_delta
+        elif self.is_recording:
             bpy.context.scene.frame_set(frame_idx)
             bpy.data.scenes["Scene"].frame_end = frame_idx + 1
         left = data['hands'].get('Left')
         right = data['hands'].get('Right')
         if left:
-            self.left_hand.process_bones(left['relative_rotations'], left['relative_scales'])
+            self.process_hand(self.left_hand, left)
         if right:
-            self.right_hand.process_bones(right['relative_rotations'], right['relative_scales'])
+            self.process_hand(self.right_hand, right)
 
         self.prev_timestamp = current_timestamp
         logger.debug(f"Timestamps: {timestamp_delta} {current_timestamp} {self.prev_timestamp} {data['ts']}")
 
+    def process_hand(self, hand, data):
+        # Hands without a rig in the scene, e.g. a retarget map that only configures one hand, are skipped
+        if hand is None or hand.object is None:
+            return
+        keyframe = self.is_recording and not self.exporters
+        rotations, scales = hand.process_bones(data['relative_rotations'], data['relative_scales'], keyframe=keyframe)
+        exporter = self.exporters.get(hand.prefix)
+        if exporter is not None:
+            try:
+                exporter.write(self.export_frame, rotations, scales)
+            except Exception:
+                # Losing the take shouldn't drop the live connection
+                logger.exception(f"Failed to export {exporter.path}, recording stopped")
+                self.is_recording = False
+                self.stop_export()
+
+    def start_export(self, mode, path):
+        # Streams processed rotations to one file per hand, e.g. take_left.bvh and take_right.bvh
+        root = splitext(bpy.path.abspath(path))[0]
+        extension = '.bvh' if mode == 'BVH' else '.npz'
+        self.export_frame = None
+        try:
+            for hand in (self.left_hand, self.right_hand):
+                if hand is None or hand.object is None:
+                    continue
+                hand_path = f"{root}_{hand.prefix.rstrip('_')}{extension}"
+                if mode == 'BVH':
+                    self.exporters[hand.prefix] = BvhStreamWriter(
+                        hand_path, hand.plan.bone_names, hand.plan.parent_indices,
+                        hand.rest_heads, hand.rest_tails, hand.rest_quats,
+                    )
+                else:
+                    self.exporters[hand.prefix] = NpzStreamWriter(hand_path, hand.plan.bone_names)
+        except Exception:
+            self.stop_export()
+            raise
+        if not self.exporters:
+            # Otherwise recording would silently fall back to keyframing
+            raise ValueError("No hand rigs to export")
+
+    def stop_export(self):
+        exporters, self.exporters = self.exporters, {}
+        for exporter in exporters.values():
+            try:
+                exporter.close()
+            except Exception:
+                logger.exception(f"Failed to export {exporter.path}")
+
     async def websocket_handler(self, request):
         logger.debug('websocket connected')
         ws = aiohttp.web.WebSocketResponse()
@@ -144,16 +199,12 @@ class Receiver:
         return self.site._port
 
     def init_hands(self):
-        self.left_hand = minimal_hand.Hand("left_")
-        self.right_hand = minimal_hand.Hand("right_")
-
-        if not self.left_hand.object and not self.right_hand.object:
-            minimal_hand.load_hands()
-        self.left_hand.save_pose()
-        self.right_hand.save_pose()
-        if bpy.context.object is not None:
-            bpy.ops.object.mode_set(mode="OBJECT")
-        bpy.ops.object.select_all(action="DESELECT")
+        try:
+            self.left_hand, self.right_hand = minimal_hand.init_hands()
+        except (OSError, ValueError):
+            # A broken retarget map shouldn't drop the connection, frames are ignored until it's fixed
+            logger.exception("Failed to set up hand rigs")
+            self.left_hand = self.right_hand = None
 
     @property
     def is_connected(self):
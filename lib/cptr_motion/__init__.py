@@ -0,0 +1,3 @@
+# bpy-independent motion processing.
+# Nothing in this package may import bpy or mathutils: it is imported by Blender as well as by
+# worker processes and offline tools that run on a plain Python interpreter with NumPy.
@@ -0,0 +1,132 @@
+import argparse
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import orjson as json
+except ModuleNotFoundError:
+    import json
+
+from . import hand as hand_math
+from .retarget import RetargetPlan
+
+# Armature prefix -> hand name in the frame messages
+hands = dict(left_='Left', right_='Right')
+
+
+def frame_timestamp(ts):
+    if isinstance(ts, str):
+        return datetime.fromisoformat(ts).timestamp()
+    return ts
+
+
+def read_take(path):
+    # A take is a JSON-lines dump of the messages received by Receiver.websocket_handler, only frames are used
+    messages = []
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            if data.get('type') == 'frame':
+                messages.append(data)
+    return messages
+
+
+def frame_indices(messages):
+    if not messages:
+        return np.zeros(0, dtype=np.int64)
+    timestamps = [frame_timestamp(data['ts']) for data in messages]
+    # Same rounding as Receiver.process_data, so batch takes line up with live recordings
+    deltas = [0] + [int((current - prev) * 100) for prev, current in zip(timestamps, timestamps[1:])]
+    return np.cumsum(deltas, dtype=np.int64)
+
+
+def last_per_frame(frames):
+    # Live recording overwrites keyframes that fall on the same frame, keep the last message for each frame
+    _, reversed_idx = np.unique(frames[::-1], return_index=True)
+    return np.sort(len(frames) - 1 - reversed_idx)
+
+
+def process_take(path, out_path, plans):
+    # plans: armature prefix -> compiled RetargetPlan of the target rig, hands without a plan are skipped
+    messages = read_take(path)
+    frames = frame_indices(messages)
+
+    arrays = {}
+    for prefix, plan in plans.items():
+        name = hands[prefix]
+        idx = np.array([i for i, data in enumerate(messages) if data['hands'].get(name)], dtype=np.int64)
+        idx = idx[last_per_frame(frames[idx])]
+        relative_rotations = np.array(
+            [messages[i]['hands'][name]['relative_rotations'] for i in idx], dtype=np.float64,
+        ).reshape(-1, hand_math.joint_count, 4)
+        relative_scales = np.array(
+            [messages[i]['hands'][name]['relative_scales'] for i in idx], dtype=np.float64,
+        ).reshape(-1, hand_math.joint_count - 1)
+
+        rotations, scales = plan.apply(relative_rotations, relative_scales)
+
+        arrays[prefix + 'bones'] = np.array(plan.bone_names)
+        arrays[prefix + 'frames'] = frames[idx]
+        arrays[prefix + 'rotations'] = rotations.astype(np.float32)
+        arrays[prefix + 'scales'] = scales.astype(np.float32)
+
+    np.savez(out_path, **arrays)
+    return out_path
+
+
+def take_output_path(path, out_dir):
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(out_dir, name + '.npz')
+
+
+def process_takes(paths, out_dir, plans, workers=None, executable=None):
+    # Each take is decoded and retargeted in its own worker process.
+    # Spawn instead of fork, forking Blender with its running threads is not safe.
+    # Workers are started with sys.executable unless executable points at another Python interpreter.
+    os.makedirs(out_dir, exist_ok=True)
+    out_paths = [take_output_path(path, out_dir) for path in paths]
+    context = multiprocessing.get_context('spawn')
+    if executable:
+        context.set_executable(executable)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        return list(executor.map(process_take, paths, out_paths, [plans] * len(paths)))
+
+
+def save_plans(path, plans):
+    arrays = {}
+    for prefix, plan in plans.items():
+        arrays.update(plan.to_arrays(prefix))
+    np.savez(path, **arrays)
+
+
+def load_plans(path):
+    with np.load(path) as data:
+        return {
+            prefix: RetargetPlan.from_arrays(data, prefix)
+            for prefix in hands
+            if prefix + 'joint_indices' in data
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert recorded CPTR.tech takes to NPZ animation data")
+    parser.add_argument('takes', nargs='+', help="JSON-lines dumps of received messages")
+    parser.add_argument('-o', '--out-dir', default='.', help="Directory for the NPZ files")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="Number of worker processes, all cores by default")
+    parser.add_argument(
+        '--plans', required=True, help="NPZ with the compiled retarget plans of the rigs, see Export Retarget Plans",
+    )
+    args = parser.parse_args()
+
+    for out_path in process_takes(args.takes, args.out_dir, load_plans(args.plans), args.jobs):
+        print(out_path)
+
+
+if __name__ == '__main__':
+    main()
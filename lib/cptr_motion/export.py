@@ -0,0 +1,244 @@
+import logging
+import queue
+from abc import ABC, abstractmethod
+import threading
+import zipfile
+
+import numpy as np
+
+from .hand import quat_invert, quat_multiply
+
+logger = logging.getLogger(__name__)
+
+# Frame indices are timestamp deltas in hundredths of a second, same as Receiver.process_data
+frame_time = 0.01
+
+
+class StreamWriter(ABC):
+    # Collects processed frames into fixed-size chunks that a background thread writes to disk.
+    # Memory stays bounded by max_chunks for takes of any length: when the writer falls that many chunks
+    # behind, write() blocks until the oldest chunk is on disk.
+    # Frames arriving on an already written frame index replace the previous pose.
+    repeat_gaps = False
+
+    def __init__(self, path, bone_names, chunk_size=256, max_chunks=8):
+        self.path = path
+        self.bone_names = list(bone_names)
+        self.chunk_size = chunk_size
+        self.frame_count = 0
+        self.pending = None
+        self.error = None
+        self.new_chunk()
+        # Opened on the caller's thread, so a bad path is reported before recording starts
+        self.open()
+        self.queue = queue.Queue(maxsize=max_chunks)
+        self.thread = threading.Thread(target=self.run, name=f"cptr-export-{path}", daemon=True)
+        self.thread.start()
+
+    def new_chunk(self):
+        bone_count = len(self.bone_names)
+        self.chunk_frames = np.empty(self.chunk_size, dtype=np.int64)
+        self.chunk_rotations = np.empty((self.chunk_size, bone_count, 4), dtype=np.float32)
+        self.chunk_scales = np.empty((self.chunk_size, bone_count), dtype=np.float32)
+        self.chunk_length = 0
+
+    def write(self, frame, rotations, scales):
+        if self.error is not None:
+            raise self.error
+        if self.pending is not None and frame > self.pending[0]:
+            # BVH has a fixed frame time, so skipped frames hold the previous pose
+            repeats = frame - self.pending[0] if self.repeat_gaps else 1
+            for offset in range(repeats):
+                self.append(self.pending[0] + offset, *self.pending[1:])
+        if self.pending is None or frame >= self.pending[0]:
+            self.pending = (frame, rotations, scales)
+
+    def append(self, frame, rotations, scales):
+        idx = self.chunk_length
+        self.chunk_frames[idx] = frame
+        self.chunk_rotations[idx] = rotations
+        self.chunk_scales[idx] = scales
+        self.chunk_length += 1
+        self.frame_count += 1
+        if self.chunk_length == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.chunk_length:
+            length = self.chunk_length
+            self.queue.put((self.chunk_frames[:length], self.chunk_rotations[:length], self.chunk_scales[:length]))
+            self.new_chunk()
+
+    def close(self):
+        if self.pending is not None:
+            self.append(*self.pending)
+            self.pending = None
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        try:
+            try:
+                while True:
+                    chunk = self.queue.get()
+                    if chunk is None:
+                        break
+                    self.write_chunk(*chunk)
+            finally:
+                self.finish()
+        except Exception as exc:
+            logger.exception(f"Failed to write {self.path}")
+            self.error = exc
+            # Keep draining so that the recording thread never blocks on a full queue
+            while self.queue.get() is not None:
+                pass
+
+    @abstractmethod
+    def open(self):
+        pass
+
+    @abstractmethod
+    def write_chunk(self, frames, rotations, scales):
+        pass
+
+    @abstractmethod
+    def finish(self):
+        pass
+
+
+class NpzStreamWriter(StreamWriter):
+    # Every chunk is stored as separate frames_#####, rotations_##### and scales_##### arrays, see read_npz_stream
+    def open(self):
+        self.zip_file = zipfile.ZipFile(self.path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+        self.chunk_index = 0
+        self.write_array('bones', np.array(self.bone_names))
+
+    def write_array(self, name, array):
+        with self.zip_file.open(name + '.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, np.asarray(array), allow_pickle=False)
+
+    def write_chunk(self, frames, rotations, scales):
+        suffix = f'_{self.chunk_index:05d}'
+        self.write_array('frames' + suffix, frames)
+        self.write_array('rotations' + suffix, rotations)
+        self.write_array('scales' + suffix, scales)
+        self.chunk_index += 1
+
+    def finish(self):
+        self.zip_file.close()
+
+
+def read_npz_stream(path):
+    # Concatenates the chunks written by NpzStreamWriter into bones, frames, rotations and scales
+    with np.load(path) as data:
+        chunks = sorted(name for name in data.files if name.startswith('frames_'))
+        suffixes = [name[len('frames'):] for name in chunks]
+        result = dict(bones=data['bones'])
+        for name, shape in (('frames', (0,)), ('rotations', (0, len(result['bones']), 4)), ('scales', (0, len(result['bones'])))):
+            arrays = [data[name + suffix] for suffix in suffixes]
+            result[name] = np.concatenate(arrays) if arrays else np.zeros(shape)
+        return result
+
+
+def quats_to_matrices(quats):
+    w, x, y, z = np.moveaxis(np.asarray(quats, dtype=np.float64), -1, 0)
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)], axis=-1),
+        np.stack([2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)], axis=-1),
+        np.stack([2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)], axis=-1),
+    ], axis=-2)
+
+
+def matrices_to_zxy_eulers(matrices):
+    # Angles in degrees for the "Zrotation Xrotation Yrotation" channel order, R = Rz @ Rx @ Ry
+    x = np.arcsin(np.clip(matrices[..., 2, 1], -1., 1.))
+    y = np.arctan2(-matrices[..., 2, 0], matrices[..., 2, 2])
+    z = np.arctan2(-matrices[..., 0, 1], matrices[..., 1, 1])
+    return np.degrees(np.stack([z, x, y], axis=-1))
+
+
+class BvhStreamWriter(StreamWriter):
+    # Joint offsets and rotation axes are in armature space of the rig, rotations are relative to its rest pose.
+    # The frame count isn't known up front, so the header reserves space for it and is patched on close.
+    repeat_gaps = True
+    frame_count_width = 12
+
+    def __init__(self, path, bone_names, parent_indices, rest_heads, rest_tails, rest_quats, chunk_size=256, max_chunks=8):
+        self.parent_indices = np.asarray(parent_indices)
+        if np.count_nonzero(self.parent_indices < 0) != 1:
+            raise ValueError("BVH export needs a rig with exactly one root bone")
+        self.rest_heads = np.asarray(rest_heads, dtype=np.float64)
+        self.rest_tails = np.asarray(rest_tails, dtype=np.float64)
+        self.rest_quats = np.asarray(rest_quats, dtype=np.float64)
+        self.inverted_rest_quats = quat_invert(self.rest_quats)
+        super().__init__(path, bone_names, chunk_size, max_chunks)
+
+    def hierarchy(self):
+        lines = ["HIERARCHY"]
+
+        def add_joint(idx, depth):
+            indent = "\t" * depth
+            parent = self.parent_indices[idx]
+            if parent < 0:
+                lines.append(f"{indent}ROOT {self.bone_names[idx]}")
+                offset = self.rest_heads[idx]
+                channels = "CHANNELS 6 Xposition Yposition Zposition Zrotation Xrotation Yrotation"
+            else:
+                lines.append(f"{indent}JOINT {self.bone_names[idx]}")
+                offset = self.rest_heads[idx] - self.rest_heads[parent]
+                channels = "CHANNELS 3 Zrotation Xrotation Yrotation"
+            lines.append(f"{indent}{{")
+            lines.append(f"{indent}\tOFFSET {offset[0]:.6f} {offset[1]:.6f} {offset[2]:.6f}")
+            lines.append(f"{indent}\t{channels}")
+            children = np.flatnonzero(self.parent_indices == idx)
+            for child in children:
+                add_joint(child, depth + 1)
+            if not len(children):
+                # Leaf bones keep their length through the end site at the bone tail
+                tip = self.rest_tails[idx] - self.rest_heads[idx]
+                lines.append(f"{indent}\tEnd Site")
+                lines.append(f"{indent}\t{{")
+                lines.append(f"{indent}\t\tOFFSET {tip[0]:.6f} {tip[1]:.6f} {tip[2]:.6f}")
+                lines.append(f"{indent}\t}}")
+            lines.append(f"{indent}}}")
+
+        add_joint(int(np.flatnonzero(self.parent_indices < 0)[0]), 0)
+        return lines
+
+    def open(self):
+        self.file = open(self.path, 'wb')
+        lines = self.hierarchy()
+        # Channels are written in the order joints appear in the hierarchy
+        self.channel_order = self.preorder()
+        self.root = self.channel_order[0]
+        header = "\n".join(lines + ["MOTION", "Frames: "])
+        self.file.write(header.encode())
+        self.frame_count_offset = self.file.tell()
+        self.file.write(f"{0:<{self.frame_count_width}d}\nFrame Time: {frame_time:.6f}\n".encode())
+        self.written_frames = 0
+
+    def preorder(self):
+        order = []
+        stack = [int(np.flatnonzero(self.parent_indices < 0)[0])]
+        while stack:
+            idx = stack.pop()
+            order.append(idx)
+            stack.extend(reversed(np.flatnonzero(self.parent_indices == idx).tolist()))
+        return order
+
+    def write_chunk(self, frames, rotations, scales):
+        # Local bone rotations are expressed along armature axes: rest @ local @ rest^-1
+        rotations = quat_multiply(quat_multiply(self.rest_quats, rotations), self.inverted_rest_quats)
+        eulers = matrices_to_zxy_eulers(quats_to_matrices(rotations[:, self.channel_order]))
+        root_positions = np.broadcast_to(self.rest_heads[self.root], (len(frames), 3))
+        values = np.concatenate([root_positions, eulers.reshape(len(frames), -1)], axis=-1)
+        np.savetxt(self.file, values, fmt='%.6f')
+        self.written_frames += len(frames)
+
+    def finish(self):
+        self.file.seek(self.frame_count_offset)
+        self.file.write(f"{self.written_frames:<{self.frame_count_width}d}".encode())
+        self.file.close()
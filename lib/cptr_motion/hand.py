@@ -0,0 +1,120 @@
+import numpy as np
+
+
+mpii_joints = [
+    "root",
+
+    "thumb1",
+    "thumb2",
+    "thumb3",
+    "thumb4",
+
+    "index1",
+    "index2",
+    "index3",
+    "index4",
+
+    "middle1",
+    "middle2",
+    "middle3",
+    "middle4",
+
+    "ring1",
+    "ring2",
+    "ring3",
+    "ring4",
+
+    "pinky1",
+    "pinky2",
+    "pinky3",
+    "pinky4",
+]
+
+mpii_parents = dict(
+    root=None,
+
+    thumb1='root',
+    thumb2='thumb1',
+    thumb3='thumb2',
+    thumb4='thumb3',
+
+    index1='root',
+    index2='index1',
+    index3='index2',
+    index4='index3',
+
+    middle1='root',
+    middle2='middle1',
+    middle3='middle2',
+    middle4='middle3',
+
+    ring1='root',
+    ring2='ring1',
+    ring3='ring2',
+    ring4='ring3',
+
+    pinky1='root',
+    pinky2='pinky1',
+    pinky3='pinky2',
+    pinky4='pinky3',
+)
+
+# Index of every joint's parent in mpii_joints, -1 for the root.
+# Parents always come before their children, so a single forward pass resolves the chain.
+mpii_parent_indices = np.array([
+    mpii_joints.index(mpii_parents[joint]) if mpii_parents[joint] else -1
+    for joint in mpii_joints
+])
+
+joint_count = len(mpii_joints)
+
+
+# Quaternions are stored as (..., 4) arrays in (w, x, y, z) order, same as mathutils.Quaternion
+
+def identity_quats(*shape):
+    quats = np.zeros(shape + (4,))
+    quats[..., 0] = 1.
+    return quats
+
+
+def quat_multiply(a, b):
+    aw, ax, ay, az = np.moveaxis(np.asarray(a, dtype=np.float64), -1, 0)
+    bw, bx, by, bz = np.moveaxis(np.asarray(b, dtype=np.float64), -1, 0)
+    return np.stack([
+        aw * bw - ax * bx - ay * by - az * bz,
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw,
+    ], axis=-1)
+
+
+def quat_invert(quats):
+    quats = np.asarray(quats, dtype=np.float64)
+    inverted = quats * np.array([1., -1., -1., -1.])
+    return inverted / np.sum(quats * quats, axis=-1, keepdims=True)
+
+
+def compute_to_ref_quats(rest_quats, rest_lengths, present=None):
+    # rest_quats: (J, 4) armature space rest rotations of the bones, rest_lengths: (J,) bone lengths.
+    # Joints that are missing from the rig (present[idx] is False) take the rest pose of their parent.
+    # Returns to_ref_quats (J, 4) and ref_scales (J,) that RetargetPlan.compile bakes into the plan.
+    rest_quats = np.array(rest_quats, dtype=np.float64)
+    rest_lengths = np.array(rest_lengths, dtype=np.float64)
+    if present is None:
+        present = np.ones(joint_count, dtype=bool)
+
+    ref_quats = identity_quats(joint_count)
+    ref_scales = np.ones(joint_count)
+    parent_quats = identity_quats(joint_count)
+    for idx, parent in enumerate(mpii_parent_indices):
+        if present[idx]:
+            ref_quats[idx] = rest_quats[idx]
+            ref_scales[idx] = rest_lengths[idx]
+        elif parent >= 0:
+            ref_quats[idx] = ref_quats[parent]
+            ref_scales[idx] = ref_scales[parent]
+        if parent >= 0:
+            parent_quats[idx] = ref_quats[parent]
+
+    to_ref_quats = quat_multiply(quat_invert(ref_quats), parent_quats)
+    return to_ref_quats, ref_scales
@@ -0,0 +1,140 @@
+import logging
+
+import numpy as np
+
+from .hand import (
+    compute_to_ref_quats, identity_quats, joint_count, mpii_joints, mpii_parent_indices,
+    quat_invert, quat_multiply,
+)
+
+logger = logging.getLogger(__name__)
+
+# Rotation that brings each bone axis onto +Y, the axis bones of the bundled hand point along
+axis_alignments = {
+    'Y': (1., 0., 0., 0.),
+    '-Y': (0., 0., 0., 1.),
+    'X': (np.sqrt(.5), 0., 0., np.sqrt(.5)),
+    '-X': (np.sqrt(.5), 0., 0., -np.sqrt(.5)),
+    'Z': (np.sqrt(.5), -np.sqrt(.5), 0., 0.),
+    '-Z': (np.sqrt(.5), np.sqrt(.5), 0., 0.),
+}
+
+
+def offset_quat(axis='Y', roll=0.):
+    # Rotation from the bone frame of the target rig to the frame of the bundled hand:
+    # axis is the local bone axis that points along the finger, roll is in degrees around the finger
+    if not isinstance(roll, (int, float)) or isinstance(roll, bool):
+        raise ValueError(f"Bone roll must be a number of degrees, got {roll!r}")
+    if not isinstance(axis, str) or axis not in axis_alignments:
+        raise ValueError(f"Unknown bone axis {axis!r}, expected one of {', '.join(axis_alignments)}")
+    half_roll = np.radians(roll) / 2
+    roll_quat = (np.cos(half_roll), 0., np.sin(half_roll), 0.)
+    return quat_multiply(roll_quat, axis_alignments[axis])
+
+
+class RetargetPlan:
+    # Maps MPII joints onto bones of an arbitrary rig.
+    # mapping is {joint: bone_name} or {joint: dict(bone=bone_name, axis='Y', roll=0.)}, unmapped joints are skipped.
+    # After compile() with the rest pose of the rig, apply() turns relative rotations into local bone
+    # rotations for all mapped bones and any number of frames with a few array operations.
+    def __init__(self, mapping):
+        joint_indices = []
+        bone_names = []
+        offset_quats = []
+        for joint, target in mapping.items():
+            if joint not in mpii_joints:
+                raise ValueError(f"Unknown joint {joint!r}")
+            if isinstance(target, str):
+                target = dict(bone=target)
+            if not isinstance(target, dict) or 'bone' not in target:
+                raise ValueError(f"Joint {joint!r} must map to a bone name or an object with a bone key")
+            if not isinstance(target['bone'], str):
+                raise ValueError(f"Bone of joint {joint!r} must be a name, got {target['bone']!r}")
+            joint_indices.append(mpii_joints.index(joint))
+            bone_names.append(target['bone'])
+            offset_quats.append(offset_quat(target.get('axis', 'Y'), target.get('roll', 0.)))
+
+        order = np.argsort(joint_indices, kind='stable')
+        self.joint_indices = np.array(joint_indices, dtype=np.int64)[order]
+        self.bone_names = [bone_names[idx] for idx in order]
+        self.offset_quats = np.array(offset_quats, dtype=np.float64).reshape(-1, 4)[order]
+        self.left_quats = quat_invert(self.offset_quats)
+        self.scale_factors = np.ones(len(self.bone_names))
+
+    @classmethod
+    def identity(cls):
+        # Plan for the bundled hand rig, its bones are named after the joints
+        return cls({joint: joint for joint in mpii_joints})
+
+    @property
+    def parent_indices(self):
+        # Index of the nearest mapped ancestor of every bone in bone_names, -1 for bones without one
+        bone_of_joint = {int(joint): idx for idx, joint in enumerate(self.joint_indices)}
+        parents = []
+        for joint in self.joint_indices:
+            parent = int(mpii_parent_indices[joint])
+            while parent >= 0 and parent not in bone_of_joint:
+                parent = int(mpii_parent_indices[parent])
+            parents.append(bone_of_joint.get(parent, -1))
+        return np.array(parents, dtype=np.int64)
+
+    def restricted(self, bone_names):
+        # Copy of the plan without bones that are missing from the rig, their joints fall back to parents
+        keep = np.array([name in bone_names for name in self.bone_names], dtype=bool)
+        dropped = [name for name, kept in zip(self.bone_names, keep) if not kept]
+        if dropped:
+            logger.warning(f"Mapped bones not found in the rig, their joints follow the parent: {', '.join(dropped)}")
+        plan = RetargetPlan({})
+        plan.joint_indices = self.joint_indices[keep]
+        plan.bone_names = [name for name, kept in zip(self.bone_names, keep) if kept]
+        plan.offset_quats = self.offset_quats[keep]
+        plan.left_quats = self.left_quats[keep]
+        plan.scale_factors = self.scale_factors[keep]
+        return plan
+
+    def compile(self, rest_quats, rest_lengths):
+        # rest_quats: (B, 4) armature space rest rotations and rest_lengths: (B,) lengths of bone_names.
+        # Bakes the reference quaternion chain and axis corrections into per-bone arrays.
+        present = np.zeros(joint_count, dtype=bool)
+        present[self.joint_indices] = True
+        joint_rest_quats = identity_quats(joint_count)
+        joint_rest_quats[self.joint_indices] = quat_multiply(rest_quats, quat_invert(self.offset_quats))
+        joint_rest_lengths = np.ones(joint_count)
+        joint_rest_lengths[self.joint_indices] = rest_lengths
+
+        to_ref_quats, ref_scales = compute_to_ref_quats(joint_rest_quats, joint_rest_lengths, present)
+        parent_scales = np.where(mpii_parent_indices >= 0, ref_scales[mpii_parent_indices], 1.)
+
+        self.left_quats = quat_multiply(quat_invert(self.offset_quats), to_ref_quats[self.joint_indices])
+        self.scale_factors = (parent_scales / ref_scales)[self.joint_indices]
+
+    def apply(self, relative_rotations, relative_scales):
+        # relative_rotations: (..., J, 4) and relative_scales: (..., J - 1) as sent by CPTR.tech.
+        # Returns local rotations (..., B, 4) and uniform local scales (..., B) of bone_names.
+        relative_rotations = np.asarray(relative_rotations, dtype=np.float64)[..., self.joint_indices, :]
+        rotations = quat_multiply(quat_multiply(self.left_quats, relative_rotations), self.offset_quats)
+
+        relative_scales = np.asarray(relative_scales, dtype=np.float64)
+        root_scales = np.ones(relative_scales.shape[:-1] + (1,))
+        relative_scales = np.concatenate([root_scales, relative_scales], axis=-1)
+        scales = relative_scales[..., self.joint_indices] * self.scale_factors
+        return rotations, scales
+
+    def to_arrays(self, prefix=''):
+        return {
+            prefix + 'joint_indices': self.joint_indices,
+            prefix + 'bone_names': np.array(self.bone_names),
+            prefix + 'offset_quats': self.offset_quats,
+            prefix + 'left_quats': self.left_quats,
+            prefix + 'scale_factors': self.scale_factors,
+        }
+
+    @classmethod
+    def from_arrays(cls, data, prefix=''):
+        plan = cls({})
+        plan.joint_indices = np.asarray(data[prefix + 'joint_indices'])
+        plan.bone_names = [str(name) for name in data[prefix + 'bone_names']]
+        plan.offset_quats = np.asarray(data[prefix + 'offset_quats'])
+        plan.left_quats = np.asarray(data[prefix + 'left_quats'])
+        plan.scale_factors = np.asarray(data[prefix + 'scale_factors'])
+        return plan
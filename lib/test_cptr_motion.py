@@ -0,0 +1,349 @@
+import json
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from cptr_motion import batch, hand as hand_math
+from cptr_motion.export import (
+    BvhStreamWriter, NpzStreamWriter, matrices_to_zxy_eulers, quats_to_matrices, read_npz_stream,
+)
+from cptr_motion.retarget import RetargetPlan, offset_quat
+
+joint_count = hand_math.joint_count
+
+
+def random_quats(rng, *shape):
+    quats = rng.normal(size=shape + (4,))
+    return quats / np.linalg.norm(quats, axis=-1, keepdims=True)
+
+
+def same_rotation(a, b):
+    # q and -q are the same rotation
+    return np.allclose(np.abs(np.sum(a * b, axis=-1)), 1.)
+
+
+def reference_chain(rest_quats, rest_lengths, present, relative_rotations, relative_scales):
+    # Per-joint implementation from before the NumPy engine, Hand.save_pose and Hand.process_bones
+    ref_quats = {None: np.array([1., 0., 0., 0.])}
+    ref_scales = {None: 1.}
+    to_ref_quats = {}
+    for idx, joint in enumerate(hand_math.mpii_joints):
+        parent = hand_math.mpii_parents[joint]
+        if present[idx]:
+            ref_quats[joint] = rest_quats[idx]
+            ref_scales[joint] = rest_lengths[idx]
+        else:
+            ref_quats[joint] = ref_quats[parent]
+            ref_scales[joint] = ref_scales[parent]
+        to_ref_quats[joint] = hand_math.quat_multiply(hand_math.quat_invert(ref_quats[joint]), ref_quats[parent])
+
+    rotations = []
+    scales = []
+    for idx, joint in enumerate(hand_math.mpii_joints):
+        parent = hand_math.mpii_parents[joint]
+        rel_scale = relative_scales[idx - 1] if idx else 1.
+        rotations.append(hand_math.quat_multiply(to_ref_quats[joint], relative_rotations[idx]))
+        scales.append(rel_scale * ref_scales[parent] / ref_scales[joint])
+    return np.array(rotations), np.array(scales)
+
+
+def bone_world_quats(parent_indices, rest_quats, local_quats):
+    # Armature space rotations of posed bones, the way Blender chains pose bones
+    world_quats = np.empty_like(local_quats)
+    for idx, parent in enumerate(parent_indices):
+        base = rest_quats[idx]
+        if parent >= 0:
+            base = hand_math.quat_multiply(
+                hand_math.quat_multiply(world_quats[parent], hand_math.quat_invert(rest_quats[parent])), base)
+        world_quats[idx] = hand_math.quat_multiply(base, local_quats[idx])
+    return world_quats
+
+
+def test_plan_matches_reference_chain():
+    rng = np.random.default_rng(0)
+    rest_quats = random_quats(rng, joint_count)
+    rest_lengths = rng.uniform(.5, 2., joint_count)
+    present = rng.uniform(size=joint_count) > .3
+    present[0] = True
+    present[hand_math.mpii_joints.index("index2")] = False
+    relative_rotations = random_quats(rng, 5, joint_count)
+    relative_scales = rng.uniform(.5, 2., (5, joint_count - 1))
+
+    # Joints missing from the rig aren't mapped, the plan falls back to their parents like the reference
+    plan = RetargetPlan({joint: joint for joint, kept in zip(hand_math.mpii_joints, present) if kept})
+    plan.compile(rest_quats[present], rest_lengths[present])
+    rotations, scales = plan.apply(relative_rotations, relative_scales)
+
+    assert rotations.shape == (5, np.count_nonzero(present), 4)
+    assert scales.shape == (5, np.count_nonzero(present))
+    for frame in range(5):
+        expected_rotations, expected_scales = reference_chain(
+            rest_quats, rest_lengths, present, relative_rotations[frame], relative_scales[frame])
+        assert np.allclose(rotations[frame], expected_rotations[present])
+        assert np.allclose(scales[frame], expected_scales[present])
+
+
+def test_plan_single_frame():
+    rng = np.random.default_rng(1)
+    plan = RetargetPlan.identity()
+    plan.compile(random_quats(rng, joint_count), rng.uniform(.5, 2., joint_count))
+    relative_rotations = random_quats(rng, 3, joint_count)
+    relative_scales = rng.uniform(.5, 2., (3, joint_count - 1))
+
+    rotations, scales = plan.apply(relative_rotations, relative_scales)
+    single_rotations, single_scales = plan.apply(relative_rotations[1], relative_scales[1])
+    assert plan.bone_names == hand_math.mpii_joints
+    assert np.allclose(single_rotations, rotations[1])
+    assert np.allclose(single_scales, scales[1])
+
+
+def test_offset_quat_aligns_axis_with_y():
+    axes = {'X': (1, 0, 0), '-X': (-1, 0, 0), 'Y': (0, 1, 0), '-Y': (0, -1, 0), 'Z': (0, 0, 1), '-Z': (0, 0, -1)}
+    for axis, vector in axes.items():
+        quat = offset_quat(axis, roll=37.)
+        rotated = hand_math.quat_multiply(hand_math.quat_multiply(quat, (0.,) + vector), hand_math.quat_invert(quat))
+        assert np.allclose(rotated, (0., 0., 1., 0.)), axis
+
+
+def test_plan_with_axis_and_roll_corrections():
+    # A rig whose bones are the bundled ones rotated by the offsets must end up posed the same,
+    # up to those offsets
+    rng = np.random.default_rng(3)
+    rest_quats = random_quats(rng, joint_count)
+    rest_lengths = rng.uniform(.5, 2., joint_count)
+    relative_rotations = random_quats(rng, joint_count)
+    relative_scales = rng.uniform(.5, 2., joint_count - 1)
+
+    axes = ['X', '-Z', 'Y', '-X', 'Z', '-Y']
+    mapping = {}
+    offsets = []
+    for idx, joint in enumerate(hand_math.mpii_joints):
+        axis, roll = axes[idx % len(axes)], idx * 13.
+        mapping[joint] = dict(bone='rig_' + joint, axis=axis, roll=roll)
+        offsets.append(offset_quat(axis, roll))
+    offsets = np.array(offsets)
+    rig_rest_quats = hand_math.quat_multiply(rest_quats, offsets)
+
+    identity = RetargetPlan.identity()
+    identity.compile(rest_quats, rest_lengths)
+    plan = RetargetPlan(mapping)
+    plan.compile(rig_rest_quats, rest_lengths)
+    assert plan.bone_names == ['rig_' + joint for joint in hand_math.mpii_joints]
+
+    bundled_rotations, bundled_scales = identity.apply(relative_rotations, relative_scales)
+    rig_rotations, rig_scales = plan.apply(relative_rotations, relative_scales)
+    parents = hand_math.mpii_parent_indices
+    bundled_world = bone_world_quats(parents, rest_quats, bundled_rotations)
+    rig_world = bone_world_quats(parents, rig_rest_quats, rig_rotations)
+    assert same_rotation(hand_math.quat_multiply(hand_math.quat_invert(bundled_world), rig_world), offsets)
+    assert np.allclose(rig_scales, bundled_scales)
+
+
+@pytest.mark.parametrize('target', [
+    dict(bone='hand', roll='90'),
+    dict(bone='hand', axis=['Y']),
+    dict(bone='hand', axis='W'),
+    dict(bone=1),
+    dict(axis='Y'),
+    ['hand'],
+])
+def test_malformed_mapping_raises_value_error(target):
+    with pytest.raises(ValueError):
+        RetargetPlan(dict(root=target))
+
+
+def test_restricted_plan_skips_missing_bones():
+    plan = RetargetPlan(dict(root='hand', index1='index.01', index2='index.02', index3='index.03'))
+    restricted = plan.restricted({'hand', 'index.01', 'index.03'})
+    assert restricted.bone_names == ['hand', 'index.01', 'index.03']
+    assert list(restricted.parent_indices) == [-1, 0, 1]
+
+
+def test_npz_stream_round_trip(tmp_path):
+    rng = np.random.default_rng(4)
+    bone_names = hand_math.mpii_joints
+    path = str(tmp_path / 'take.npz')
+    writer = NpzStreamWriter(path, bone_names, chunk_size=4)
+    frames = [0, 1, 1, 3, 4, 5, 8, 9, 12, 13]
+    written = {}
+    for frame in frames:
+        rotations = random_quats(rng, joint_count).astype(np.float32)
+        scales = rng.uniform(.5, 2., joint_count).astype(np.float32)
+        writer.write(frame, rotations, scales)
+        # A frame arriving again on the same index replaces the previous pose
+        written[frame] = (rotations, scales)
+    writer.close()
+
+    data = read_npz_stream(path)
+    assert list(data['bones']) == bone_names
+    assert list(data['frames']) == sorted(written)
+    assert np.array_equal(data['rotations'], np.array([written[frame][0] for frame in sorted(written)]))
+    assert np.array_equal(data['scales'], np.array([written[frame][1] for frame in sorted(written)]))
+
+
+def zxy_matrix(z, x, y):
+    z, x, y = np.radians([z, x, y])
+    rz = np.array([[np.cos(z), -np.sin(z), 0.], [np.sin(z), np.cos(z), 0.], [0., 0., 1.]])
+    rx = np.array([[1., 0., 0.], [0., np.cos(x), -np.sin(x)], [0., np.sin(x), np.cos(x)]])
+    ry = np.array([[np.cos(y), 0., np.sin(y)], [0., 1., 0.], [-np.sin(y), 0., np.cos(y)]])
+    return rz @ rx @ ry
+
+
+def test_zxy_eulers_round_trip():
+    rng = np.random.default_rng(5)
+    quats = random_quats(rng, 50)
+    matrices = quats_to_matrices(quats)
+    for matrix, (z, x, y) in zip(matrices, matrices_to_zxy_eulers(matrices)):
+        assert np.allclose(zxy_matrix(z, x, y), matrix)
+
+    # quats_to_matrices rotates vectors the same way as q v q^-1
+    vector = np.array([.3, .2, .9])
+    rotated = hand_math.quat_multiply(hand_math.quat_multiply(quats[0], np.r_[0., vector]), hand_math.quat_invert(quats[0]))
+    assert np.allclose(matrices[0] @ vector, rotated[1:])
+
+
+def bvh_writer(path, rng):
+    plan = RetargetPlan.identity()
+    heads = rng.normal(size=(joint_count, 3))
+    return BvhStreamWriter(
+        path, plan.bone_names, plan.parent_indices, heads, heads + 1., random_quats(rng, joint_count), chunk_size=4,
+    )
+
+
+def read_bvh_motion(path):
+    with open(path) as f:
+        lines = f.read().splitlines()
+    motion = lines.index('MOTION')
+    frame_count = int(lines[motion + 1].split()[1])
+    rows = np.array([[float(value) for value in line.split()] for line in lines[motion + 3:]])
+    return lines[:motion], frame_count, rows
+
+
+def test_bvh_stream_repeats_gaps_and_patches_frame_count(tmp_path):
+    rng = np.random.default_rng(6)
+    path = str(tmp_path / 'take.bvh')
+    writer = bvh_writer(path, rng)
+    poses = {}
+    for frame in [0, 3, 3, 5]:
+        poses[frame] = random_quats(rng, joint_count)
+        writer.write(frame, poses[frame], np.ones(joint_count))
+    writer.close()
+
+    header, frame_count, rows = read_bvh_motion(path)
+    assert frame_count == 6
+    assert rows.shape == (6, 6 + 3 * (joint_count - 1))
+    # Frames 1 and 2 hold the pose of frame 0, frame 4 the last pose received for frame 3
+    expected_frames = [poses[0], poses[0], poses[0], poses[3], poses[3], poses[5]]
+
+    # Channels follow the joints in hierarchy order, rotations along armature axes: rest @ local @ rest^-1
+    joints = [line.split()[1] for line in header if line.strip().startswith(('ROOT', 'JOINT'))]
+    order = [writer.bone_names.index(joint) for joint in joints]
+    for row, local_quats in zip(rows, expected_frames):
+        assert np.allclose(row[:3], writer.rest_heads[writer.root])
+        eulers = row[3:].reshape(-1, 3)
+        armature_quats = hand_math.quat_multiply(
+            hand_math.quat_multiply(writer.rest_quats, local_quats), writer.inverted_rest_quats)
+        for (z, x, y), idx in zip(eulers, order):
+            assert np.allclose(zxy_matrix(z, x, y), quats_to_matrices(armature_quats[idx]), atol=1e-5)
+
+
+def test_bvh_stream_needs_single_root(tmp_path):
+    plan = RetargetPlan(dict(index1='index.01', middle1='middle.01'))
+    assert list(plan.parent_indices) == [-1, -1]
+    with pytest.raises(ValueError):
+        BvhStreamWriter(
+            str(tmp_path / 'take.bvh'), plan.bone_names, plan.parent_indices,
+            np.zeros((2, 3)), np.ones((2, 3)), hand_math.identity_quats(2),
+        )
+
+
+def test_frame_indices_match_receiver_rounding():
+    timestamps = [1000., 1000.016, 1000.031, 1000.031, 1000.049, 1000.2]
+    messages = [dict(ts=ts) for ts in timestamps]
+    # ISO timestamps are accepted as well, like in Receiver.process_data
+    messages[2]['ts'] = datetime.fromtimestamp(timestamps[2]).isoformat()
+
+    # Receiver.process_data: frame += int((current_timestamp - prev_timestamp) * 100)
+    expected = [0]
+    for prev, current in zip(timestamps, timestamps[1:]):
+        expected.append(expected[-1] + int((current - prev) * 100))
+    assert list(batch.frame_indices(messages)) == expected
+    assert list(batch.frame_indices([])) == []
+
+
+def test_last_per_frame():
+    frames = np.array([0, 1, 1, 3, 3, 3, 4])
+    assert list(batch.last_per_frame(frames)) == [0, 2, 5, 6]
+
+
+def write_take(path, messages):
+    with open(path, 'w') as f:
+        f.write(json.dumps(dict(type='state', isRunning=True)) + '\n')
+        for data in messages:
+            f.write(json.dumps(data) + '\n')
+
+
+def test_process_take(tmp_path):
+    rng = np.random.default_rng(7)
+    plan = RetargetPlan.identity()
+    plan.compile(random_quats(rng, joint_count), rng.uniform(.5, 2., joint_count))
+
+    timestamps = [1000., 1000.0625, 1000.0703125, 1000.125, 1000.25, 1000.375]
+    messages = []
+    for idx, ts in enumerate(timestamps):
+        hands = {}
+        if idx != 4:
+            hands['Left'] = dict(
+                relative_rotations=random_quats(rng, joint_count).tolist(),
+                relative_scales=rng.uniform(.5, 2., joint_count - 1).tolist(),
+            )
+        messages.append(dict(type='frame', ts=ts, hands=hands))
+    take_path = str(tmp_path / 'take.jsonl')
+    write_take(take_path, messages)
+
+    out_path = batch.process_take(take_path, str(tmp_path / 'take.npz'), {'left_': plan})
+    data = np.load(out_path)
+    assert 'right_frames' not in data
+
+    # The third message falls on the same frame as the second and replaces it, the fifth has no left hand
+    frames = batch.frame_indices(messages)
+    kept = [0, 2, 3, 5]
+    assert list(frames) == [0, 6, 6, 11, 23, 35]
+    assert list(data['left_frames']) == list(frames[kept])
+    assert list(data['left_bones']) == plan.bone_names
+    rotations, scales = plan.apply(
+        [messages[idx]['hands']['Left']['relative_rotations'] for idx in kept],
+        [messages[idx]['hands']['Left']['relative_scales'] for idx in kept],
+    )
+    assert np.allclose(data['left_rotations'], rotations, atol=1e-6)
+    assert np.allclose(data['left_scales'], scales, atol=1e-6)
+
+
+def test_process_empty_take(tmp_path):
+    take_path = str(tmp_path / 'empty.jsonl')
+    write_take(take_path, [])
+
+    data = np.load(batch.process_take(take_path, str(tmp_path / 'empty.npz'), {'left_': RetargetPlan.identity()}))
+    assert data['left_frames'].shape == (0,)
+    assert data['left_rotations'].shape == (0, joint_count, 4)
+    assert data['left_scales'].shape == (0, joint_count)
+
+
+def test_plans_round_trip(tmp_path):
+    rng = np.random.default_rng(8)
+    left = RetargetPlan(dict(root='hand.L', index1=dict(bone='index.01.L', axis='X', roll=30.)))
+    left.compile(random_quats(rng, 2), rng.uniform(.5, 2., 2))
+    right = RetargetPlan.identity()
+    right.compile(random_quats(rng, joint_count), rng.uniform(.5, 2., joint_count))
+    path = str(tmp_path / 'plans.npz')
+    batch.save_plans(path, {'left_': left, 'right_': right})
+
+    plans = batch.load_plans(path)
+    relative_rotations = random_quats(rng, 3, joint_count)
+    relative_scales = rng.uniform(.5, 2., (3, joint_count - 1))
+    for prefix, plan in (('left_', left), ('right_', right)):
+        assert plans[prefix].bone_names == plan.bone_names
+        for loaded, expected in zip(plans[prefix].apply(relative_rotations, relative_scales),
+                                    plan.apply(relative_rotations, relative_scales)):
+            assert np.allclose(loaded, expected)
@@ -2,7 +2,9 @@ if "bpy" not in locals():
     import bpy
     from . import receiver
     from . import hands
+    from . import batch
 else:
     import importlib
     importlib.reload(receiver)
     importlib.reload(hands)
+    importlib.reload(batch)
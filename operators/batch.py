@@ -0,0 +1,92 @@
+import bpy
+import glob
+import logging
+import os
+
+import numpy as np
+from bpy.props import IntProperty, StringProperty
+
+from ..core.minimal_hand import import_take, init_hands
+from cptr_motion import batch
+
+logger = logging.getLogger(__name__)
+
+
+class BatchConvertTakes(bpy.types.Operator):
+    bl_idname = "cptr.batch_convert_takes"
+    bl_label = "Convert Takes"
+    bl_description = "Convert all recorded takes (.jsonl) in a folder to NPZ in parallel and import them as actions"
+    bl_options = {'INTERNAL'}
+
+    directory: StringProperty(subtype='DIR_PATH')
+    jobs: IntProperty(
+        name='Jobs',
+        description="Number of worker processes, 0 uses all cores",
+        default=0,
+        min=0,
+    )
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        paths = sorted(glob.glob(os.path.join(self.directory, '*.jsonl')))
+        if not paths:
+            self.report({'ERROR'}, 'No .jsonl takes found')
+            return {'CANCELLED'}
+
+        try:
+            hands = [hand for hand in init_hands() if hand.object is not None]
+        except (OSError, ValueError) as exc:
+            self.report({'ERROR'}, str(exc))
+            return {'CANCELLED'}
+        plans = {hand.prefix: hand.plan for hand in hands}
+        try:
+            # Before Blender 2.91 sys.executable is the Blender binary, workers need the bundled Python
+            executable = getattr(bpy.app, 'binary_path_python', None)
+            out_paths = batch.process_takes(paths, self.directory, plans, self.jobs or None, executable)
+        except Exception as exc:
+            logger.exception("Exception while converting takes")
+            self.report({'ERROR'}, str(exc))
+            return {'CANCELLED'}
+
+        scene = context.scene
+        for out_path in out_paths:
+            name = os.path.splitext(os.path.basename(out_path))[0]
+            with np.load(out_path) as data:
+                import_take(hands, name, data, frame_offset=scene.frame_current)
+                for hand in hands:
+                    frames = data[hand.prefix + 'frames']
+                    if len(frames):
+                        scene.frame_end = max(scene.frame_end, scene.frame_current + int(frames[-1]) + 1)
+
+        self.report({'INFO'}, f'Converted {len(out_paths)} takes')
+        return {'FINISHED'}
+
+
+class ExportRetargetPlans(bpy.types.Operator):
+    bl_idname = "cptr.export_retarget_plans"
+    bl_label = "Export Retarget Plans"
+    bl_description = "Save the compiled retarget plans of the hand rigs for offline batch conversion"
+    bl_options = {'INTERNAL'}
+
+    filepath: StringProperty(subtype='FILE_PATH', default='retarget_plans.npz')
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        try:
+            plans = {hand.prefix: hand.plan for hand in init_hands() if hand.object is not None}
+        except (OSError, ValueError) as exc:
+            self.report({'ERROR'}, str(exc))
+            return {'CANCELLED'}
+        if not plans:
+            self.report({'ERROR'}, 'No hand rigs found')
+            return {'CANCELLED'}
+
+        batch.save_plans(bpy.path.ensure_ext(self.filepath, '.npz'), plans)
+        self.report({'INFO'}, f'Exported retarget plans for {len(plans)} hands')
+        return {'FINISHED'}
@@ -1,6 +1,6 @@
 import bpy
 
-from ..core.minimal_hand import Hand, load_hands
+from ..core.minimal_hand import load_hands, load_retarget_map, make_hands
 
 
 class ResetHands(bpy.types.Operator):
@@ -10,8 +10,13 @@ class ResetHands(bpy.types.Operator):
     bl_options = {'INTERNAL'}
 
     def execute(self, context):
-        Hand('left_').reset_pose()
-        Hand('right_').reset_pose()
+        try:
+            hands = make_hands(load_retarget_map())
+        except (OSError, ValueError) as exc:
+            self.report({'ERROR'}, str(exc))
+            return {'CANCELLED'}
+        for hand in hands:
+            hand.reset_pose()
         return {'FINISHED'}
 
 
@@ -1,7 +1,10 @@
 import bpy
+import logging
 
 from ..core.receiver import receiver
 
+logger = logging.getLogger(__name__)
+
 
 class RecorderStart(bpy.types.Operator):
     bl_idname = "cptr.recorder_start"
@@ -14,6 +17,15 @@ class RecorderStart(bpy.types.Operator):
             self.report({'ERROR'}, 'Already recording')
             return {'CANCELLED'}
 
+        prefs = context.preferences.addons['cptr-tech'].preferences
+        if prefs.record_mode != 'KEYFRAMES':
+            try:
+                receiver.start_export(prefs.record_mode, prefs.export_path)
+            except Exception as exc:
+                logger.exception("Exception while starting export")
+                self.report({'ERROR'}, str(exc))
+                return {'CANCELLED'}
+
         receiver.is_recording = True
         return {'FINISHED'}
 
@@ -30,4 +42,5 @@ class RecorderStop(bpy.types.Operator):
             return {'CANCELLED'}
 
         receiver.is_recording = False
+        receiver.stop_export()
         return {'FINISHED'}
@@ -4,6 +4,7 @@ from ..core.receiver import receiver
 from ..core.icon_manager import Icons
 from ..operators.recorder import RecorderStart, RecorderStop
 from ..operators.hands import ResetHands, LoadHands
+from ..operators.batch import BatchConvertTakes, ExportRetargetPlans
 from ..operators.receiver import ReceiverStart, ReceiverStop
 
 row_scale = 0.75
@@ -55,6 +56,12 @@ class ReceiverPanel(ToolPanel, bpy.types.Panel):
         else:
             row.operator(ReceiverStart.bl_idname, icon='PLAY')
 
+        row = col.row(align=True)
+        row.enabled = not receiver.is_recording
+        row.prop(prefs, 'record_mode', text='')
+        if prefs.record_mode != 'KEYFRAMES':
+            row.prop(prefs, 'export_path', text='')
+
         row = layout.row(align=True)
         row.scale_y = 1.3
         row.enabled = receiver.is_running
@@ -71,6 +78,11 @@ class ReceiverPanel(ToolPanel, bpy.types.Panel):
         row.enabled = True
         row.operator(LoadHands.bl_idname)
 
+        row = layout.row(align=True)
+        row.enabled = not receiver.is_running
+        row.operator(BatchConvertTakes.bl_idname)
+        row.operator(ExportRetargetPlans.bl_idname, text='', icon='EXPORT')
+
 
 def add_indent(split, empty=False):
     row = split.row(align=True)
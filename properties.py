@@ -1,4 +1,4 @@
-from bpy.props import IntProperty
+from bpy.props import EnumProperty, IntProperty, StringProperty
 from bpy.types import AddonPreferences
 from bpy.utils import register_class
 
@@ -15,6 +15,34 @@ class CptrPreferences(AddonPreferences):
         max=65535,
         update=receiver.change_port,
     )
+    retarget_map: StringProperty(
+        name='Retarget Map',
+        description="JSON file mapping hand joints to bones of custom rigs, bundled hands are used if empty",
+        subtype='FILE_PATH',
+    )
+    record_mode: EnumProperty(
+        name='Record To',
+        description="Where recorded takes are written",
+        items=[
+            ('KEYFRAMES', 'Keyframes', "Insert keyframes into the scene"),
+            ('BVH', 'BVH', "Stream to one BVH file per hand without keyframing"),
+            ('NPZ', 'NPZ', "Stream to one NumPy archive per hand without keyframing"),
+        ],
+        default='KEYFRAMES',
+    )
+    export_path: StringProperty(
+        name='Export Path',
+        description="Base file name for streamed takes, _left or _right and the extension are appended",
+        default='//take',
+        subtype='FILE_PATH',
+    )
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(self, 'receiver_port')
+        layout.prop(self, 'retarget_map')
+        layout.prop(self, 'record_mode')
+        layout.prop(self, 'export_path')
 
 
 def register():